@@ -1,12 +1,18 @@
 # app.py — Flask API (로그인/회원가입 + 장치 상태/전원 + 센서 보고 수신 + 에이전트 프록시)
-# 실행: python app.py
+# 실행(개발, 단일 프로세스): python app.py
+# 실행(운영, 멀티 워커):     gunicorn -c gunicorn.conf.py app:app
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, g, has_request_context
 from flask_cors import CORS
 from flask_session import Session
+from flask_session.sessions import SqlAlchemySessionInterface
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-import datetime, os, subprocess, platform, shutil, sqlite3
+import datetime, os, subprocess, platform, shutil, sqlite3, sys, zlib, json, functools, time, math
+from array import array
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
 import requests  # 프록시 호출용
 
 app = Flask(__name__)
@@ -25,11 +31,67 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(basedir, 'users.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB_PATH
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SESSION_TYPE'] = 'filesystem'
 app.secret_key = 'esp32_secret'
-Session(app)
 db = SQLAlchemy(app)
 
+# ---- SQLite: WAL + 쓰기 직렬화 ----
+# WAL: 읽기는 쓰기를 막지 않고, synchronous=NORMAL이면 fsync를 체크포인트 때 묶어서 수행.
+# BEGIN은 직접 발행: @write_txn 엔드포인트는 BEGIN IMMEDIATE로 시작해 처음부터 쓰기 잠금을 잡는다
+# (지연 BEGIN에서 읽기→쓰기 승격은 다른 워커와 겹치면 busy_timeout 없이 바로 실패).
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+@event.listens_for(Engine, "connect")
+def _sqlite_on_connect(dbapi_conn, _record):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    dbapi_conn.isolation_level = None
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cur.close()
+
+@event.listens_for(Engine, "begin")
+def _sqlite_on_begin(conn):
+    if conn.dialect.name != "sqlite":
+        return
+    conn.exec_driver_sql("BEGIN IMMEDIATE" if has_request_context() and g.get("write_txn") else "BEGIN")
+
+def _begin_write():
+    # 이미 열린 읽기 트랜잭션(세션 조회 등)을 닫고, 이후 트랜잭션은 BEGIN IMMEDIATE
+    db.session.commit()
+    g.write_txn = True
+
+def write_txn(fn):
+    # 짧은 읽기-수정-쓰기 엔드포인트용 (외부 호출로 오래 걸리는 프록시 엔드포인트에는 쓰지 말 것)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _begin_write()
+        return fn(*args, **kwargs)
+    return wrapper
+
+class SharedSessionInterface(SqlAlchemySessionInterface):
+    # 워커 공유 세션(DB 저장). 기본 구현은 permanent 세션을 요청마다 INSERT/UPDATE하므로
+    # 변경된 세션만 저장하고, 저장은 짧은 IMMEDIATE 트랜잭션으로 수행
+    def save_session(self, app, session, response):
+        if not session.modified:
+            return
+        _begin_write()
+        super().save_session(app, session, response)
+
+# 운영 모드(APP_MODE=production, gunicorn.conf.py가 설정): 워커 간 세션 공유를 위해 DB(또는 Redis)에 저장
+PRODUCTION = os.environ.get("APP_MODE") == "production"
+if os.environ.get("SESSION_REDIS_URL"):
+    import redis  # 선택 의존성: pip install redis
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.from_url(os.environ["SESSION_REDIS_URL"])
+    Session(app)
+elif PRODUCTION:
+    app.session_interface = SharedSessionInterface(app=app, db=db, table="sessions", key_prefix="session:")
+else:
+    app.config['SESSION_TYPE'] = 'filesystem'
+    Session(app)
+
 # ---------------- 모델 ----------------
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -47,17 +109,61 @@ class Device(db.Model):
     signal_strength = db.Column(db.String(50), default="N/A")
     distance = db.Column(db.String(50), default="N/A")
     control_url = db.Column(db.String(200), default=None)  # 에이전트 제어 URL
+    agent_metrics = db.Column(db.Text, default=None)       # 보고에 첨부된 최근 계측 요약(JSON)
 
-# ---- (마이그레이션 보정) control_url 컬럼이 없으면 추가 ----
-def ensure_control_url_column():
+class DeviceRollup(db.Model):
+    # 보고 수신 시 증분 갱신되는 집계 (device="*"는 전체 합계)
+    __table_args__ = (db.UniqueConstraint("device", "period", "bucket"),
+                      db.Index("ix_rollup_period_bucket", "period", "bucket"))
+    id = db.Column(db.Integer, primary_key=True)
+    device = db.Column(db.String(50), nullable=False)
+    period = db.Column(db.String(10), nullable=False)      # minute / hour / day
+    bucket = db.Column(db.String(20), nullable=False)      # 구간 시작 (last_updated와 같은 형식의 앞부분)
+    reports = db.Column(db.Integer, default=0)
+    detect_fast = db.Column(db.Integer, default=0)
+    detect_periodic = db.Column(db.Integer, default=0)
+    no_echo = db.Column(db.Integer, default=0)
+    out_of_range = db.Column(db.Integer, default=0)
+    pir_idle = db.Column(db.Integer, default=0)
+    other = db.Column(db.Integer, default=0)
+    dist_n = db.Column(db.Integer, default=0)
+    dist_sum = db.Column(db.Float, default=0.0)
+    dist_min = db.Column(db.Float, default=None)
+    dist_max = db.Column(db.Float, default=None)
+    dist_hist = db.Column(db.Text, default=None)           # ROLLUP_DIST_BINS_CM 구간별 개수(JSON)
+    rssi_n = db.Column(db.Integer, default=0)
+    rssi_sum = db.Column(db.Float, default=0.0)
+    rssi_min = db.Column(db.Float, default=None)
+    rssi_max = db.Column(db.Float, default=None)
+    active_minutes = db.Column(db.Integer, default=0)      # 보고가 있었던 분 수 → uptime 근사
+
+class TraceChunk(db.Model):
+    # 에이전트 원시 거리 트레이스 청크 (zlib 압축 columnar 그대로 저장)
+    # (device, boot, seq)로 유일 → 타임아웃 후 재전송된 청크는 한 번만 저장
+    __table_args__ = (db.UniqueConstraint("device", "boot", "seq"),)
+    id = db.Column(db.Integer, primary_key=True)
+    device = db.Column(db.String(50), nullable=False, index=True)
+    boot = db.Column(db.String(32), nullable=False)        # 에이전트 기동마다 새로 생성되는 id
+    seq = db.Column(db.Integer, nullable=False)
+    t0 = db.Column(db.Float, nullable=False, index=True)   # epoch s
+    t1 = db.Column(db.Float, nullable=False)               # 마지막 샘플 epoch s
+    n = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    received = db.Column(db.String(100))
+
+# ---- (마이그레이션 보정) 나중에 추가된 Device 컬럼이 없으면 추가 ----
+DEVICE_ADDED_COLUMNS = {"control_url": "TEXT", "agent_metrics": "TEXT"}
+
+def ensure_device_columns():
     try:
         with sqlite3.connect(DB_PATH) as conn:
             cur = conn.execute("PRAGMA table_info(Device)")
             cols = [r[1] for r in cur.fetchall()]
-            if "control_url" not in cols:
-                conn.execute("ALTER TABLE Device ADD COLUMN control_url TEXT")
-                conn.commit()
-                print("[DB] Added column control_url to Device")
+            for name, typ in DEVICE_ADDED_COLUMNS.items():
+                if name not in cols:
+                    conn.execute(f"ALTER TABLE Device ADD COLUMN {name} {typ}")
+                    print(f"[DB] Added column {name} to Device")
+            conn.commit()
     except Exception as e:
         print("[DB] Column check/add failed:", e)
 
@@ -139,19 +245,114 @@ def trigger_process(device_name: str, turn_on: bool):
 # ---------------- 에이전트 프록시 ----------------
 AGENT_TIMEOUT = 2.5
 
-def _agent_post(d: Device, path: str):
-    if not d or not d.control_url:
+def _agent_post(control_url: str, path: str):
+    if not control_url:
         return False, "control_url 없음"
     try:
-        r = requests.post(f"{d.control_url}{path}", timeout=AGENT_TIMEOUT)
+        r = requests.post(f"{control_url}{path}", timeout=AGENT_TIMEOUT)
         if r.status_code == 200:
             return True, r.text
         return False, f"HTTP {r.status_code}"
     except Exception as e:
         return False, str(e)
 
+# ---------------- 원시 트레이스 청크 ----------------
+# raspberry.py TraceRecorder와 동일한 레이아웃: 열 단위 배열을 순서대로 이어붙인 뒤 zlib (리틀엔디언)
+TRACE_COLUMNS = (("dt_ms", "I"), ("dist_dmm", "H"), ("err", "B"), ("pir", "B"), ("src", "B"))
+TRACE_ERR_NAMES = {0: None, 1: "ECHO_LOW_TIMEOUT", 2: "ECHO_HIGH_TIMEOUT"}
+TRACE_SRC_NAMES = {0: "fast", 1: "median"}
+TRACE_MAX_SAMPLES = 100_000
+TRACE_DEFAULT_WINDOW_S = 3600  # since 생략 시 최근 1시간
+
+TRACE_ROW_BYTES = sum(array(code).itemsize for _, code in TRACE_COLUMNS)  # 9
+
+def _decode_trace(blob: bytes, n: int):
+    # 압축 해제는 기대 크기 + 1바이트까지만 (압축 폭탄 방지)
+    expected = n * TRACE_ROW_BYTES
+    dec = zlib.decompressobj()
+    raw = dec.decompress(blob, expected + 1)
+    if len(raw) > expected or dec.unconsumed_tail:
+        raise ValueError("chunk larger than n samples")
+    if not dec.eof:
+        raise ValueError("incomplete zlib stream")
+    cols, off = {}, 0
+    for name, code in TRACE_COLUMNS:
+        a = array(code)
+        size = a.itemsize * n
+        a.frombytes(raw[off:off + size])
+        if len(a) != n:
+            raise ValueError("truncated chunk")
+        if sys.byteorder == "big":
+            a.byteswap()
+        cols[name] = a; off += size
+    if off != len(raw):
+        raise ValueError("chunk size mismatch")
+    return cols
+
+@app.route("/api/trace-chunk", methods=["POST"])
+@write_txn
+def trace_chunk():
+    device = request.args.get("device"); boot = request.args.get("boot")
+    try:
+        seq = int(request.args["seq"]); n = int(request.args["n"]); t0 = float(request.args["t0"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "device, boot, seq, n, t0 필요"}), 400
+    if not device or not boot or not (0 < n <= TRACE_MAX_SAMPLES):
+        return jsonify({"error": "device, boot, seq, n, t0 필요"}), 400
+    # 형식 검증은 첫 DB 조회(= BEGIN IMMEDIATE 쓰기 잠금) 전에
+    blob = request.get_data()
+    try:
+        cols = _decode_trace(blob, n)
+    except (zlib.error, ValueError) as e:
+        return jsonify({"error": f"invalid chunk: {e}"}), 400
+    dup = TraceChunk.query.filter_by(device=device, boot=boot, seq=seq).first()
+    if dup:
+        return jsonify({"stored": False, "duplicate": True, "id": dup.id})
+    c = TraceChunk(device=device, boot=boot, seq=seq, t0=t0, t1=t0 + cols["dt_ms"][-1] / 1000.0, n=n, data=blob,
+                   received=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    db.session.add(c)
+    try:
+        db.session.commit()
+    except IntegrityError:  # 동시에 들어온 재전송
+        db.session.rollback()
+        return jsonify({"stored": False, "duplicate": True})
+    return jsonify({"stored": True, "id": c.id})
+
+@app.route("/api/trace/<name>", methods=["GET"])
+def get_trace(name):
+    # 재생/임계값 튜닝용: [since, until] 구간 샘플을 열 단위로 반환 (since 생략 시 최근 1시간, 최대 TRACE_MAX_SAMPLES개)
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    if since is None:
+        since = time.time() - TRACE_DEFAULT_WINDOW_S
+    if until is None:
+        until = float("inf")
+    q = TraceChunk.query.filter(TraceChunk.device == name, TraceChunk.t1 >= since)
+    if until != float("inf"):
+        q = q.filter(TraceChunk.t0 <= until)
+    out = {"t": [], "distance": [], "error": [], "pir": [], "src": []}
+    for c in q.order_by(TraceChunk.t0.asc()).yield_per(16):  # 청크를 조금씩 읽고 상한에 닿으면 중단
+        if len(out["t"]) >= TRACE_MAX_SAMPLES:
+            break
+        cols = _decode_trace(c.data, c.n)
+        for i in range(c.n):
+            t = c.t0 + cols["dt_ms"][i] / 1000.0
+            if t < since or t > until:
+                continue
+            if len(out["t"]) >= TRACE_MAX_SAMPLES:
+                break
+            err = cols["err"][i]; pir = cols["pir"][i]
+            out["t"].append(round(t, 3))
+            out["distance"].append(None if err else cols["dist_dmm"][i] / 10.0)
+            out["error"].append(TRACE_ERR_NAMES.get(err, "UNKNOWN"))
+            out["pir"].append(None if pir == 255 else pir)
+            out["src"].append(TRACE_SRC_NAMES.get(cols["src"][i]))
+    out["count"] = len(out["t"])
+    return jsonify(out)
+
 # ---------------- 사용자 ----------------
 @app.route('/api/register', methods=['POST'])
+@write_txn
 def register():
     data = request.json or {}
     username = data.get('username'); password = data.get('password')
@@ -179,36 +380,88 @@ def logout():
     return jsonify({"message": "Logged out successfully"}), 200
 
 # ---------------- 장치 상태 ----------------
+STATUS_FIELDS = ("id", "name", "power", "status", "last_report", "last_updated",
+                 "signal_strength", "distance", "control_url")
+STATUS_PAGE_MAX = 500
+STATUS_QUERY_PARAMS = ("fields", "limit", "cursor", "power", "prefix", "updated_within", "format")
+
+def _device_dict(d, fields=STATUS_FIELDS):
+    return {f: getattr(d, f) for f in fields}
+
 @app.route('/api/status', methods=['GET'])
 def get_status():
-    devices = Device.query.order_by(Device.id.asc()).all()
-    return jsonify([
-        {
-            "id": d.id, "name": d.name, "power": d.power, "status": d.status,
-            "last_report": d.last_report, "last_updated": d.last_updated,
-            "signal_strength": d.signal_strength, "distance": d.distance,
-            "control_url": d.control_url
-        } for d in devices
-    ])
+    """
+    파라미터가 없으면 기존처럼 전체 배열.
+    - fields=name,power,distance : 필드 선택(id는 커서용으로 항상 포함)
+    - limit, cursor              : id 기준 커서 페이지네이션 (next_cursor 반환)
+    - power=true|false, prefix=chair, updated_within=<초> : 서버측 필터
+    - format=columns             : {"fields": [...], "columns": [[...], ...]} 열 단위 응답
+    """
+    args = request.args
+    if not any(k in args for k in STATUS_QUERY_PARAMS):
+        devices = Device.query.order_by(Device.id.asc()).all()
+        return jsonify([_device_dict(d) for d in devices])
+
+    fields = [f.strip() for f in args.get("fields", ",".join(STATUS_FIELDS)).split(",") if f.strip()]
+    unknown = [f for f in fields if f not in STATUS_FIELDS]
+    if unknown:
+        return jsonify({"error": f"unknown fields: {','.join(unknown)}"}), 400
+    if "id" not in fields:
+        fields.insert(0, "id")
+    try:
+        limit = min(max(int(args.get("limit", STATUS_PAGE_MAX)), 1), STATUS_PAGE_MAX)
+        cursor = int(args["cursor"]) if args.get("cursor") else None
+        within = int(args["updated_within"]) if args.get("updated_within") else None
+    except ValueError:
+        return jsonify({"error": "limit, cursor, updated_within 은 정수"}), 400
+
+    q = Device.query
+    if cursor is not None:
+        q = q.filter(Device.id > cursor)
+    if "power" in args:
+        q = q.filter(Device.power == (args["power"].lower() in ("1", "true", "on")))
+    if args.get("prefix"):
+        q = q.filter(Device.name.startswith(args["prefix"], autoescape=True))
+    if within is not None:
+        # last_updated는 "%Y-%m-%d %H:%M:%S" 문자열 → 사전순 비교 = 시간순 비교
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=within)).strftime("%Y-%m-%d %H:%M:%S")
+        q = q.filter(Device.last_updated >= cutoff)
+    rows = (q.with_entities(*[getattr(Device, f) for f in fields])
+             .order_by(Device.id.asc()).limit(limit + 1).all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][fields.index("id")]
+    if args.get("format") == "columns":
+        return jsonify({"fields": fields, "columns": [list(c) for c in zip(*rows)] if rows else [[] for _ in fields],
+                        "count": len(rows), "next_cursor": next_cursor})
+    return jsonify({"items": [dict(zip(fields, r)) for r in rows], "count": len(rows), "next_cursor": next_cursor})
 
 @app.route('/api/status/<name>', methods=['GET'])
 def get_status_one(name):
     d = Device.query.filter_by(name=name).first()
     if not d:
         return jsonify({"error": "not found"}), 404
-    return jsonify({
-        "id": d.id, "name": d.name, "power": d.power, "status": d.status,
-        "last_report": d.last_report, "last_updated": d.last_updated,
-        "signal_strength": d.signal_strength, "distance": d.distance,
-        "control_url": d.control_url
-    })
+    return jsonify(_device_dict(d))
+
+def _agent_call(name: str, path: str):
+    # 에이전트 호출(최대 AGENT_TIMEOUT) 동안 읽기 트랜잭션을 열어두지 않는다:
+    # 읽기 종료 → 호출 → BEGIN IMMEDIATE로 장치 행을 다시 읽어 반환 (호출자가 바로 쓰고 commit)
+    d = Device.query.filter_by(name=name).first()
+    if not d:
+        return None, False, "not found"
+    control_url = d.control_url
+    db.session.commit()
+    ok, detail = _agent_post(control_url, path)
+    _begin_write()
+    return Device.query.filter_by(name=name).first(), ok, detail
 
 # ---------------- 에이전트 제어(프록시) ----------------
 @app.route('/api/agent/<name>/wake', methods=['POST'])
 def agent_wake(name):
-    d = Device.query.filter_by(name=name).first()
+    d, ok, detail = _agent_call(name, "/wake")
     if not d: return jsonify({"error": "not found"}), 404
-    ok, detail = _agent_post(d, "/wake")
     d.last_report = f"에이전트 WAKE 요청: {'성공' if ok else '실패'} / {detail}"
     d.last_updated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     if ok: d.power, d.status = True, "동작 중"
@@ -217,9 +470,8 @@ def agent_wake(name):
 
 @app.route('/api/agent/<name>/sleep', methods=['POST'])
 def agent_sleep(name):
-    d = Device.query.filter_by(name=name).first()
+    d, ok, detail = _agent_call(name, "/sleep")
     if not d: return jsonify({"error": "not found"}), 404
-    ok, detail = _agent_post(d, "/sleep")
     d.last_report = f"에이전트 SLEEP 요청: {'성공' if ok else '실패'} / {detail}"
     d.last_updated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     if ok: d.power, d.status = False, "대기 중"
@@ -228,9 +480,8 @@ def agent_sleep(name):
 
 @app.route('/api/agent/<name>/quit', methods=['POST'])
 def agent_quit(name):
-    d = Device.query.filter_by(name=name).first()
+    d, ok, detail = _agent_call(name, "/quit")
     if not d: return jsonify({"error": "not found"}), 404
-    ok, detail = _agent_post(d, "/quit")
     d.last_report = f"에이전트 QUIT 요청: {'성공' if ok else '실패'} / {detail}"
     d.last_updated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     if ok: d.power, d.status = False, "대기 중"
@@ -248,6 +499,23 @@ def agent_health(name):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/agent/<name>/metrics', methods=['GET'])
+def agent_metrics(name):
+    # 에이전트 /metrics 실시간 조회, 실패 시 보고에 첨부됐던 마지막 요약으로 대체
+    d = Device.query.filter_by(name=name).first()
+    if not d:
+        return jsonify({"error": "not found"}), 404
+    if d.control_url:
+        try:
+            r = requests.get(f"{d.control_url}/metrics", timeout=AGENT_TIMEOUT)
+            if r.status_code == 200:
+                return jsonify({"source": "live", "metrics": r.json()})
+        except Exception:
+            pass
+    if d.agent_metrics:
+        return jsonify({"source": "last_report", "metrics": json.loads(d.agent_metrics)})
+    return jsonify({"error": "metrics unavailable"}), 503
+
 # ---------------- (옵션) 기존 SSH 경로 유지 ----------------
 @app.route('/api/power', methods=['POST'])
 def set_power():
@@ -257,15 +525,22 @@ def set_power():
     if not device_name:
         return jsonify({"error": "device name required"}), 400
 
+    # 프록시/SSH 호출 동안 읽기 트랜잭션을 열어두지 않고, 호출 후 BEGIN IMMEDIATE로 다시 읽어서 기록
+    d = Device.query.filter_by(name=device_name).first()
+    control_url = d.control_url if d else None
+    db.session.commit()
+    if control_url:
+        ok, detail = _agent_post(control_url, "/wake" if power_on else "/sleep")
+    else:
+        ok, log = trigger_process(device_name, power_on)  # ← 이제 정의됨
+    _begin_write()
     d = Device.query.filter_by(name=device_name).first()
     if not d:
         d = Device(name=device_name)
         db.session.add(d)
 
     # 1순위: control_url 있으면 프록시 사용
-    if d.control_url:
-        path = "/wake" if power_on else "/sleep"
-        ok, detail = _agent_post(d, path)
+    if control_url:
         if ok:
             d.power = power_on
             d.status = "동작 중" if power_on else "대기 중"
@@ -275,7 +550,6 @@ def set_power():
         return (jsonify({"message":"전원 상태 변경","detail":detail}), 200) if ok else (jsonify({"error":"실행/중지 실패","detail":detail}), 500)
 
     # 2순위: SSH 폴백
-    ok, log = trigger_process(device_name, power_on)  # ← 이제 정의됨
     if ok:
         d.power = power_on
         d.status = "동작 중" if power_on else "대기 중"
@@ -286,9 +560,12 @@ def set_power():
 
 # ---------------- 센서 보고 수신 ----------------
 @app.route("/api/device-report", methods=["POST"])
+@write_txn
 def report():
     data = request.json or {}
     device_name = data.get("device") or data.get("deviceName") or "unknown"
+    if device_name == ROLLUP_FLEET:
+        return jsonify({"error": f"'{ROLLUP_FLEET}'는 예약된 장치 이름입니다."}), 400
     message = data.get("message", "")
     signal = data.get("signal_strength", data.get("rssi", "N/A"))
     distance = data.get("distance", "N/A")
@@ -305,11 +582,154 @@ def report():
     d.distance = str(distance) if distance is not None else "N/A"
     if control_url:
         d.control_url = control_url
+    if isinstance(data.get("metrics"), dict):
+        d.agent_metrics = json.dumps(data["metrics"])
+    # 집계 실패가 보고 수신(장치 행 갱신)을 막지 않도록 savepoint에서 실행
+    try:
+        with db.session.begin_nested():
+            rollup_report(device_name, message, distance, signal)
+    except Exception as e:
+        print("[ROLLUP] update failed:", e)
     db.session.commit()
     return jsonify({"received": True})
 
+# ---------------- 집계(rollup) ----------------
+# 보고 1건마다 (장치, "*") × (분, 시, 일) 6개 행만 갱신 → 조회는 이력 크기와 무관
+ROLLUP_PERIODS = {"minute": "%Y-%m-%d %H:%M", "hour": "%Y-%m-%d %H", "day": "%Y-%m-%d"}
+ROLLUP_DIST_BINS_CM = (25, 50, 75, 100, 130, 160, 200, 250, 300, 400)  # 상한, 마지막 칸은 400 초과
+ROLLUP_MINUTE_RETENTION_DAYS = 2
+ROLLUP_QUERY_MAX = 500
+ROLLUP_FLEET = "*"  # 전체 합계 행의 device 값 (예약어: 이 이름의 장치 보고는 거부)
+ROLLUP_KINDS = (  # 에이전트 보고 메시지 → 분류 (앞에서부터 매칭)
+    ("점등(FAST)", "detect_fast"),
+    ("점등(PERIODIC)", "detect_periodic"),
+    ("초음파 응답 없음", "no_echo"),
+    ("거리 초과", "out_of_range"),
+    ("PIR 미감지", "pir_idle"),
+)
+
+def _to_float(v):
+    # NaN/inf는 버림 (SQLite에 NULL로 저장돼 누적값이 깨짐)
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return f if math.isfinite(f) else None
+
+def _rollup_kind(message: str) -> str:
+    for key, kind in ROLLUP_KINDS:
+        if key in (message or ""):
+            return kind
+    return "other"
+
+def _rollup_row(device, period, bucket):
+    r = DeviceRollup.query.filter_by(device=device, period=period, bucket=bucket).first()
+    if r is None:
+        r = DeviceRollup(device=device, period=period, bucket=bucket, reports=0, detect_fast=0,
+                         detect_periodic=0, no_echo=0, out_of_range=0, pir_idle=0, other=0,
+                         dist_n=0, dist_sum=0.0, rssi_n=0, rssi_sum=0.0, active_minutes=0)
+        db.session.add(r)
+    return r
+
+def rollup_report(device_name, message, distance, signal, now=None):
+    now = now or datetime.datetime.now()
+    kind = _rollup_kind(message)
+    dist = _to_float(distance); rssi = _to_float(signal)
+    for dev in (device_name, ROLLUP_FLEET):
+        # 이 장치/전체의 분 버킷이 새로 생기면 시·일 버킷의 active_minutes +1
+        new_minute = False
+        for period, fmt in ROLLUP_PERIODS.items():
+            r = _rollup_row(dev, period, now.strftime(fmt))
+            if period == "minute":
+                new_minute = not r.reports
+                if new_minute and dev == ROLLUP_FLEET:
+                    cutoff = (now - datetime.timedelta(days=ROLLUP_MINUTE_RETENTION_DAYS)).strftime(fmt)
+                    DeviceRollup.query.filter(DeviceRollup.period == "minute",
+                                              DeviceRollup.bucket < cutoff).delete(synchronize_session=False)
+            if new_minute:
+                r.active_minutes += 1
+            r.reports += 1
+            setattr(r, kind, getattr(r, kind) + 1)
+            if dist is not None:
+                r.dist_n += 1; r.dist_sum = (r.dist_sum or 0.0) + dist
+                r.dist_min = dist if r.dist_min is None else min(r.dist_min, dist)
+                r.dist_max = dist if r.dist_max is None else max(r.dist_max, dist)
+                hist = json.loads(r.dist_hist) if r.dist_hist else [0] * (len(ROLLUP_DIST_BINS_CM) + 1)
+                hist[next((i for i, b in enumerate(ROLLUP_DIST_BINS_CM) if dist <= b), len(ROLLUP_DIST_BINS_CM))] += 1
+                r.dist_hist = json.dumps(hist)
+            if rssi is not None:
+                r.rssi_n += 1; r.rssi_sum = (r.rssi_sum or 0.0) + rssi
+                r.rssi_min = rssi if r.rssi_min is None else min(r.rssi_min, rssi)
+                r.rssi_max = rssi if r.rssi_max is None else max(r.rssi_max, rssi)
+
+def _hist_quantile(hist, n, q, lo_all, hi_all):
+    # 해당 구간 안에서 선형 보간, 구간 경계는 관측 최솟값/최댓값으로 좁힘
+    if not n: return None
+    rank = q * n; acc = 0
+    for i, c in enumerate(hist):
+        if c and acc + c >= rank:
+            lo = max(ROLLUP_DIST_BINS_CM[i - 1] if i else 0.0, lo_all)
+            hi = min(ROLLUP_DIST_BINS_CM[i] if i < len(ROLLUP_DIST_BINS_CM) else hi_all, hi_all)
+            v = lo + (hi - lo) * (rank - acc) / c
+            return round(min(max(v, lo_all), hi_all), 1)
+        acc += c
+    return hi_all
+
+def _rollup_dict(r):
+    hist = json.loads(r.dist_hist) if r.dist_hist else []
+    return {
+        "device": r.device, "period": r.period, "bucket": r.bucket, "reports": r.reports,
+        "detections": {"fast": r.detect_fast, "periodic": r.detect_periodic},
+        "no_echo": r.no_echo, "out_of_range": r.out_of_range, "pir_idle": r.pir_idle, "other": r.other,
+        "no_echo_rate": round(r.no_echo / r.reports, 4) if r.reports else None,
+        "distance": {
+            "n": r.dist_n, "min": r.dist_min, "max": r.dist_max,
+            "mean": round(r.dist_sum / r.dist_n, 1) if r.dist_n and r.dist_sum is not None else None,
+            "p50": _hist_quantile(hist, r.dist_n, 0.5, r.dist_min, r.dist_max),
+            "p90": _hist_quantile(hist, r.dist_n, 0.9, r.dist_min, r.dist_max),
+            "bins_cm": list(ROLLUP_DIST_BINS_CM), "hist": hist,
+        },
+        "rssi": {"n": r.rssi_n, "min": r.rssi_min, "max": r.rssi_max,
+                 "mean": round(r.rssi_sum / r.rssi_n, 1) if r.rssi_n and r.rssi_sum is not None else None},
+        "uptime_s": r.active_minutes * 60 if r.period != "minute" else (60 if r.reports else 0),
+    }
+
+@app.route("/api/rollups", methods=["GET"])
+def get_rollups():
+    """
+    장치(기본 "*" = 전체) 한 개의 버킷 시계열.
+    ?device=chair1&period=hour&since=2026-10-19 00&until=2026-10-19 23&limit=24 (최신순)
+    """
+    period = request.args.get("period", "hour")
+    if period not in ROLLUP_PERIODS:
+        return jsonify({"error": f"period는 {', '.join(ROLLUP_PERIODS)} 중 하나"}), 400
+    limit = min(max(request.args.get("limit", 24, type=int), 1), ROLLUP_QUERY_MAX)
+    q = DeviceRollup.query.filter_by(device=request.args.get("device", ROLLUP_FLEET), period=period)
+    if request.args.get("since"):
+        q = q.filter(DeviceRollup.bucket >= request.args["since"])
+    if request.args.get("until"):
+        q = q.filter(DeviceRollup.bucket <= request.args["until"])
+    rows = q.order_by(DeviceRollup.bucket.desc()).limit(limit).all()
+    return jsonify([_rollup_dict(r) for r in rows])
+
+@app.route("/api/rollups/latest", methods=["GET"])
+def get_rollups_latest():
+    # 대시보드용: 현재(또는 ?bucket=) 구간의 장치별 집계 + 전체 합계
+    period = request.args.get("period", "hour")
+    if period not in ROLLUP_PERIODS:
+        return jsonify({"error": f"period는 {', '.join(ROLLUP_PERIODS)} 중 하나"}), 400
+    bucket = request.args.get("bucket") or datetime.datetime.now().strftime(ROLLUP_PERIODS[period])
+    rows = DeviceRollup.query.filter_by(period=period, bucket=bucket).all()
+    fleet = next((r for r in rows if r.device == ROLLUP_FLEET), None)
+    return jsonify({
+        "period": period, "bucket": bucket,
+        "fleet": _rollup_dict(fleet) if fleet else None,
+        "devices": [_rollup_dict(r) for r in sorted(rows, key=lambda r: r.device) if r.device != ROLLUP_FLEET],
+    })
+
 # (선택) 수동 시드
 @app.route("/api/seed", methods=["POST"])
+@write_txn
 def seed():
     names = (request.json or {}).get("names", ["chair1"])
     created = []
@@ -323,13 +743,17 @@ def seed():
 def health():
     return jsonify({"ok": True, "devices": Device.query.count()})
 
-if __name__ == '__main__':
+def init_db():
+    # 스키마 생성/보정 + 기본 시드. 운영 모드에서는 gunicorn 마스터가 워커 fork 전에 1회만 호출
     with app.app_context():
         db.create_all()
-        ensure_control_url_column()  # 컬럼 보정
+        ensure_device_columns()  # 컬럼 보정
         if Device.query.count() == 0:
             db.session.add(Device(name="chair1"))
             db.session.commit()
             print("[INIT] seeded default device: chair1")
+
+if __name__ == '__main__':
+    init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
 
@@ -0,0 +1,50 @@
+# bench_server.py — 서버 처리량 측정 (단일 프로세스 vs gunicorn 멀티 워커 비교용)
+# 실행: python bench_server.py --url http://localhost:5000 --clients 32 --seconds 20
+#   센서 보고(POST /api/device-report)와 대시보드 폴링(GET /api/status)을 섞어서 보냄
+
+import argparse, random, statistics, threading, time
+import requests
+
+def main():
+    parser = argparse.ArgumentParser(description="Flask API throughput benchmark")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--status-ratio", type=float, default=0.2, help="GET /api/status 비율")
+    args = parser.parse_args()
+
+    lat, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def client(i):
+        s = requests.Session(); rnd = random.Random(i)
+        mine, bad = [], 0
+        while time.monotonic() < deadline:
+            t = time.perf_counter()
+            try:
+                if rnd.random() < args.status_ratio:
+                    r = s.get(f"{args.url}/api/status", timeout=10)
+                else:
+                    r = s.post(f"{args.url}/api/device-report", timeout=10, json={
+                        "device": f"bench{rnd.randrange(args.devices)}", "message": "bench",
+                        "distance": round(rnd.uniform(20, 300), 1), "signal_strength": -60})
+                if r.status_code != 200: bad += 1
+            except Exception:
+                bad += 1
+            mine.append(time.perf_counter() - t)
+        with lock:
+            lat.extend(mine); errors[0] += bad
+
+    ths = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for th in ths: th.start()
+    for th in ths: th.join()
+
+    lat.sort()
+    n = len(lat)
+    print(f"requests={n} errors={errors[0]} rps={n / args.seconds:.1f} "
+          f"p50={statistics.median(lat) * 1000:.1f}ms p99={lat[int(n * 0.99) - 1] * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+# gunicorn.conf.py — 운영 모드(멀티 워커)
+# 실행: gunicorn -c gunicorn.conf.py app:app
+#   WORKERS / THREADS / BIND 환경변수로 조정, SESSION_REDIS_URL 지정 시 세션을 Redis에 저장
+import os, multiprocessing
+
+os.environ.setdefault("APP_MODE", "production")  # app.py import 전에 설정돼야 함
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 4))  # 에이전트 프록시 대기(최대 2.5s) 중에도 다른 요청 처리
+timeout = 30
+accesslog = "-"
+
+def on_starting(server):
+    # create_all / 컬럼 보정 / 시드는 워커마다가 아니라 마스터에서 1회
+    from app import app, db, init_db
+    init_db()
+    with app.app_context():
+        db.engine.dispose()  # fork 전에 커넥션 정리 (워커는 각자 새로 연결)
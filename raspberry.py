@@ -3,9 +3,11 @@
 # + Fast ultrasonic tracking (0.1s) + Anti-flicker LED latch + Buzzer PWM volume control
 # sudo apt -y install python3-rpi.gpio python3-requests wireless-tools iw
 
-import sys, time, argparse, statistics, subprocess, threading, socket, json
+import sys, time, argparse, statistics, subprocess, threading, socket, json, queue, collections, zlib, uuid
+from array import array
 import datetime as dt
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
 import requests
 import RPi.GPIO as GPIO
 
@@ -28,7 +30,8 @@ MEASUREMENT_INTERVAL_MS    = 3000   # 주기측정
 COOLDOWN_MS                = 3000
 POWER_POLL_MS              = 3000
 REPORT_MIN_INTERVAL_MS     = 1000
-WARMUP_SECONDS_DEFAULT     = 45
+WARMUP_SECONDS_DEFAULT     = 45     # 이 동안은 초음파 단독 모드로 보호
+WARMUP_CONSEC_CLOSE        = 3      # 초음파 단독 모드(PIR 미사용)에서는 연속 근접 횟수를 더 요구
 ULTRA_TIMEOUT_S            = 0.04
 ULTRA_SAMPLES              = 3
 DIST_MIN_CM, DIST_MAX_CM   = 2.0, 400.0
@@ -48,11 +51,131 @@ USE_BUZZER_PWM   = True     # True면 PWM으로 평균출력 낮춰 음량 감
 BUZZER_PWM_FREQ  = 5000     # 2 kHz 게이팅 (필요시 1500~4000 튜닝)
 BUZZER_PWM_DUTY  = 30       # % (작을수록 더 조용함. 예: 10~30)
 
+# --- 실시간 스트림(/stream) / 스냅샷(/snapshot) ---
+STREAM_QUEUE_MAX           = 256    # 구독자별 버퍼, 가득 차면 가장 오래된 이벤트 폐기
+SNAPSHOT_MAX               = 600    # 최근 거리 샘플 보관 수 (0.1s × 600 = 60s)
+STREAM_KEEPALIVE_S         = 15
+
+# --- 원시 거리 트레이스(모든 샘플 기록 → 압축 청크 업로드) ---
+TRACE_ENABLED              = True
+TRACE_CHUNK_SAMPLES        = 1200   # 청크당 최대 샘플 (fast 10Hz 기준 약 2분)
+TRACE_CHUNK_MAX_AGE_S      = 60     # 샘플이 적어도 이 시간이 지나면 업로드
+TRACE_UPLOAD_QUEUE_MAX     = 32     # 업로드 대기 청크 (서버 불통 시 가장 오래된 청크 폐기)
+TRACE_UPLOAD_RETRIES       = 3
+
+# --- 자체 계측(/metrics) ---
+HIST_BOUNDS_MS             = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2500, 5000)
+METRICS_REPORT_INTERVAL_MS = 60000  # --report-metrics 시 보고에 요약 첨부 주기
+
 # ---------- util ----------
 try: sys.stdout.reconfigure(line_buffering=True)
 except Exception: pass
 log = lambda *a, **k: print(*a, **k, flush=True)
 def now_ms() -> int: return int(time.monotonic() * 1000)
+T_PROCESS_START = time.monotonic()  # time-to-first-protection 기준
+
+# ---------- 자체 계측 ----------
+class Histogram:
+    # 고정 버킷(ms) 히스토그램: observe는 O(버킷 수), 메모리 고정
+    def __init__(self, bounds=HIST_BOUNDS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.n = 0; self.total = 0.0; self.max = 0.0
+
+    def observe(self, v):
+        i = 0
+        while i < len(self.bounds) and v > self.bounds[i]: i += 1
+        self.counts[i] += 1
+        self.n += 1; self.total += v
+        if v > self.max: self.max = v
+
+    def quantile(self, q):
+        # 버킷 상한으로 근사 (마지막 버킷은 관측 최댓값)
+        if not self.n: return None
+        rank = q * self.n; acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank:
+                return min(self.bounds[i], round(self.max, 3)) if i < len(self.bounds) else round(self.max, 3)
+        return round(self.max, 3)
+
+    def summary(self):
+        return {"n": self.n, "mean": round(self.total / self.n, 3) if self.n else None,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "max": round(self.max, 3)}
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.hists = {}
+        self.started = time.monotonic()
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, ms):
+        with self._lock:
+            h = self.hists.get(name)
+            if h is None: h = self.hists[name] = Histogram()
+            h.observe(ms)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": round(time.monotonic() - self.started, 1),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {k: dict(h.summary(), buckets_ms=list(h.bounds), counts=list(h.counts))
+                               for k, h in self.hists.items()},
+            }
+
+    def summary(self):
+        # /health · 보고 첨부용 축약본 (버킷 제외)
+        with self._lock:
+            return {
+                "uptime_s": round(time.monotonic() - self.started, 1),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                **{k: h.summary() for k, h in self.hists.items()},
+            }
+
+METRICS = Metrics()
+
+class TimedLock:
+    # threading.Lock 대체: 대기 시간/점유 시간을 METRICS에 기록 (with 문 전용)
+    # METRICS 기록은 잠금 해제 후에만 → 임계 구역 안에서 METRICS._lock을 잡지 않음
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self.name = name
+        self._t_acq = 0.0
+        self._wait_ms = 0.0
+
+    def __enter__(self):
+        t = time.perf_counter()
+        self._lock.acquire()
+        self._t_acq = time.perf_counter()
+        self._wait_ms = (self._t_acq - t) * 1000
+        return self
+
+    def __exit__(self, *exc):
+        held = (time.perf_counter() - self._t_acq) * 1000
+        wait = self._wait_ms
+        self._lock.release()
+        METRICS.observe(f"{self.name}_wait_ms", wait)
+        METRICS.observe(f"{self.name}_hold_ms", held)
+        return False
+
+def sleep_tracked(sec, name):
+    # 요청한 sleep 대비 초과 시간 = 스케줄러 지터
+    t = time.perf_counter()
+    time.sleep(sec)
+    METRICS.observe(name, max(0.0, (time.perf_counter() - t - sec) * 1000))
 
 def get_local_ip():
     try:
@@ -86,9 +209,13 @@ def read_rssi():
     return None
 
 # ---------- 서버 통신 ----------
+REPORT_METRICS    = False  # --report-metrics
+_last_metrics_rep = None
+
 def report(base, device, message, distance=None, control_url=None):
+    global _last_metrics_rep
     url = f"{base}/api/device-report"
-    url = f"{base}/api/device-report"
+    t = time.perf_counter()
     payload = {
         "device": device,
         "message": message,
@@ -96,11 +223,15 @@ def report(base, device, message, distance=None, control_url=None):
         "signal_strength": read_rssi()
     }
     if control_url: payload["control_url"] = control_url
+    if REPORT_METRICS and (_last_metrics_rep is None or now_ms() - _last_metrics_rep >= METRICS_REPORT_INTERVAL_MS):
+        payload["metrics"] = METRICS.summary(); _last_metrics_rep = now_ms()
     try:
-        requests.post(url, json=payload, timeout=HTTP_TIMEOUT)
-        return True
+        ok = requests.post(url, json=payload, timeout=HTTP_TIMEOUT).ok  # 4xx/5xx도 실패로 집계
     except Exception:
-        return False
+        ok = False
+    METRICS.inc("report_ok" if ok else "report_fail")
+    METRICS.observe("report_ms", (time.perf_counter() - t) * 1000)
+    return ok
 
 def get_power_flag(base, device, default=True) -> bool:
     url = f"{base}/api/status/{device}"
@@ -169,6 +300,14 @@ def buzzer_hw_set(pin, on: bool):
 
 # ---------- 초음파 ----------
 def measure_once_cm(trig, echo, timeout_s=ULTRA_TIMEOUT_S):
+    t = time.perf_counter()
+    d, err = _measure_once_cm(trig, echo, timeout_s)
+    METRICS.observe("measure_ms", (time.perf_counter() - t) * 1000)
+    if err: METRICS.inc(err.lower())
+    elif not (DIST_MIN_CM <= d <= DIST_MAX_CM): METRICS.inc("out_of_range")
+    return d, err
+
+def _measure_once_cm(trig, echo, timeout_s):
     GPIO.output(trig, GPIO.LOW); time.sleep(2e-6)
     GPIO.output(trig, GPIO.HIGH); time.sleep(10e-6)
     GPIO.output(trig, GPIO.LOW)
@@ -187,10 +326,11 @@ def measure_once_cm(trig, echo, timeout_s=ULTRA_TIMEOUT_S):
     dist = (pulse * 34300.0) / 2.0
     return round(dist, 1), None
 
-def measure_median_cm(trig, echo, n=ULTRA_SAMPLES):
+def measure_median_cm(trig, echo, n=ULTRA_SAMPLES, pir=None):
     samples = []; last_err = None
     for _ in range(n):
         d, err = measure_once_cm(trig, echo)
+        TRACE.record("median", d, err, pir)
         last_err = err or last_err
         if d is not None and DIST_MIN_CM <= d <= DIST_MAX_CM:
             samples.append(d)
@@ -199,6 +339,148 @@ def measure_median_cm(trig, echo, n=ULTRA_SAMPLES):
         return None, last_err
     return round(statistics.median(samples), 1), last_err
 
+# ---------- 원시 트레이스 ----------
+# 샘플 1개 = 9바이트 열 단위(columnar) 배열, 리틀엔디언. 서버 app.py의 TRACE_COLUMNS와 동일해야 함
+#   dt_ms(uint32, 청크 t0 기준 ms) / dist_dmm(uint16, 0.1cm 단위, 오류 시 0) / err / pir(255=미상) / src
+TRACE_ERR_CODES = {None: 0, "ECHO_LOW_TIMEOUT": 1, "ECHO_HIGH_TIMEOUT": 2}
+TRACE_SRC_CODES = {"fast": 0, "median": 1}
+
+class TraceRecorder:
+    """
+    record()는 배열 append만 하므로 센서 루프 부담이 거의 없다.
+    청크가 차거나 오래되면 잘라서 업로드 큐로 넘기고, 압축/전송은 업로더 스레드가 담당.
+    """
+    def __init__(self, chunk_samples=TRACE_CHUNK_SAMPLES, max_age_s=TRACE_CHUNK_MAX_AGE_S):
+        self.chunk_samples = chunk_samples
+        self.max_age_ms = int(max_age_s * 1000)
+        self.enabled = TRACE_ENABLED
+        self._lock = threading.Lock()
+        self._q = queue.Queue(maxsize=TRACE_UPLOAD_QUEUE_MAX)
+        self.boot = uuid.uuid4().hex[:16]  # seq는 기동마다 0부터 → 서버는 (device, boot, seq)로 중복 제거
+        self._seq = 0
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self.t0 = time.time(); self.t0_mono = time.monotonic()
+        self.cols = (array("I"), array("H"), array("B"), array("B"), array("B"))
+
+    def _cut(self):
+        if not len(self.cols[0]): return None
+        chunk = {"seq": self._seq, "t0": self.t0, "n": len(self.cols[0]), "cols": self.cols}
+        self._seq += 1
+        self._new_chunk()
+        return chunk
+
+    def _enqueue(self, chunk):
+        try:
+            self._q.put_nowait(chunk)
+        except queue.Full:
+            try: self._q.get_nowait()
+            except queue.Empty: pass
+            try: self._q.put_nowait(chunk)
+            except queue.Full: pass
+
+    def record(self, src, distance, err, pir):
+        if not self.enabled: return
+        with self._lock:
+            off = int((time.monotonic() - self.t0_mono) * 1000)
+            ts, dist, errs, pirs, srcs = self.cols
+            ts.append(off)
+            dist.append(min(int(round(distance * 10)), 0xFFFF) if distance is not None else 0)
+            errs.append(TRACE_ERR_CODES.get(err, 255))
+            pirs.append(255 if pir is None else int(pir))
+            srcs.append(TRACE_SRC_CODES.get(src, 255))
+            chunk = self._cut() if len(ts) >= self.chunk_samples or off >= self.max_age_ms else None
+        if chunk: self._enqueue(chunk)
+
+    def flush(self):
+        with self._lock:
+            chunk = self._cut()
+        if chunk: self._enqueue(chunk)
+
+    @staticmethod
+    def encode(chunk):
+        raw = bytearray()
+        for col in chunk["cols"]:
+            if sys.byteorder == "big":
+                col = array(col.typecode, col); col.byteswap()
+            raw += col.tobytes()
+        return zlib.compress(bytes(raw), 6)
+
+    def _post(self, base, device, chunk):
+        params = {"device": device, "boot": self.boot, "seq": chunk["seq"], "t0": f"{chunk['t0']:.3f}", "n": chunk["n"], "v": 1}
+        try:
+            r = requests.post(f"{base}/api/trace-chunk", params=params, data=self.encode(chunk),
+                              headers={"Content-Type": "application/octet-stream"}, timeout=HTTP_TIMEOUT)
+            return r.status_code == 200
+        except Exception:
+            return False
+
+    def run_uploader(self, base, device, stop_event):
+        while not stop_event.is_set():
+            try:
+                chunk = self._q.get(timeout=self.max_age_ms / 1000.0)
+            except queue.Empty:
+                self.flush()  # 샘플이 뜸해도 오래된 청크는 올린다
+                continue
+            for attempt in range(TRACE_UPLOAD_RETRIES):
+                if self._post(base, device, chunk): break
+                stop_event.wait(1.0 * (attempt + 1))
+            else:
+                log(f"[TRACE] chunk seq={chunk['seq']} n={chunk['n']} 업로드 실패 → 폐기")
+
+    def drain(self, base, device):
+        # 종료 시 남은 청크를 재시도 없이 한 번씩만 전송
+        self.flush()
+        while True:
+            try: chunk = self._q.get_nowait()
+            except queue.Empty: return
+            if not self._post(base, device, chunk): return
+
+TRACE = TraceRecorder()
+
+# ---------- 이벤트 허브(센서 스레드 → 스트림 구독자) ----------
+class EventHub:
+    """
+    센서 스레드는 publish()만 호출하고 절대 대기하지 않는다.
+    - 구독자별 bounded Queue에 put_nowait, 가득 차면 가장 오래된 이벤트를 버림
+    - 구독자 목록은 copy-on-write라 publish 쪽은 락 없이 순회
+    """
+    def __init__(self, recent_max=SNAPSHOT_MAX, queue_max=STREAM_QUEUE_MAX):
+        self.recent = collections.deque(maxlen=recent_max)  # 최근 거리 샘플 윈도우
+        self.queue_max = queue_max
+        self._subs = ()
+        self._subs_lock = threading.Lock()
+
+    def publish(self, kind, **fields):
+        ev = {"t": round(time.time(), 3), "type": kind, **fields}
+        if kind == "distance":
+            self.recent.append(ev)
+        for q in self._subs:
+            try:
+                q.put_nowait(ev)
+            except queue.Full:
+                try: q.get_nowait()
+                except queue.Empty: pass
+                try: q.put_nowait(ev)
+                except queue.Full: pass
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.queue_max)
+        with self._subs_lock:
+            self._subs = self._subs + (q,)
+        return q
+
+    def unsubscribe(self, q):
+        with self._subs_lock:
+            self._subs = tuple(s for s in self._subs if s is not q)
+
+    def snapshot(self, n=None):
+        items = list(self.recent)
+        return items[-n:] if n else items
+
+EVENTS = EventHub()
+
 # ---------- 전역 상태 ----------
 SYSTEM_ACTIVE      = True
 SHUTDOWN_REQUESTED = False
@@ -216,8 +498,36 @@ class CtlHandler(BaseHTTPRequestHandler):
         self.send_header("Content-Length", str(len(data))); self.end_headers()
         self.wfile.write(data)
     def log_message(self, *a): return
+    def _stream(self):
+        # SSE: 거리 샘플 + LED/부저 전환을 발생 즉시 push
+        q = EVENTS.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            while not SHUTDOWN_REQUESTED:
+                try:
+                    ev = q.get(timeout=STREAM_KEEPALIVE_S)
+                    self.wfile.write(f"event: {ev['type']}\ndata: {json.dumps(ev)}\n\n".encode("utf-8"))
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            EVENTS.unsubscribe(q)
     def do_GET(self):
-        if self.path == "/health": self._ok({"running": True, "active": SYSTEM_ACTIVE})
+        u = urlsplit(self.path); qs = parse_qs(u.query)
+        if u.path == "/health": self._ok({"running": True, "active": SYSTEM_ACTIVE, "metrics": METRICS.summary()})
+        elif u.path == "/metrics": self._ok(METRICS.snapshot())
+        elif u.path == "/stream": self._stream()
+        elif u.path == "/snapshot":
+            try: n = max(0, int(qs.get("n", ["0"])[0]))
+            except ValueError: return self._err(400, "invalid n")
+            samples = EVENTS.snapshot(n)
+            self._ok({"count": len(samples), "samples": samples})
         else: self._err(404, "not found")
     def do_POST(self):
         global SYSTEM_ACTIVE, SHUTDOWN_REQUESTED
@@ -227,7 +537,7 @@ class CtlHandler(BaseHTTPRequestHandler):
         else: self._err(404, "not found")
 
 def run_ctl_server(host, port):
-    httpd = HTTPServer((host, port), CtlHandler)
+    httpd = ThreadingHTTPServer((host, port), CtlHandler)  # 느린 클라이언트(/stream 등)가 제어 호출을 막지 않도록
     httpd.serve_forever()
 
 # ---------- 메인 ----------
@@ -245,12 +555,18 @@ def main():
     parser.add_argument("--pud",   choices=["auto","up","down"], default="auto")
     parser.add_argument("--warmup",type=int, default=WARMUP_SECONDS_DEFAULT)
     parser.add_argument("--ctl-port", type=int, default=5050)
+    parser.add_argument("--no-trace", action="store_true", help="원시 거리 트레이스 기록/업로드 끔")
+    parser.add_argument("--report-metrics", action="store_true", help="주기 보고에 계측 요약 첨부")
     args = parser.parse_args()
 
+    global REPORT_METRICS
+    REPORT_METRICS = args.report_metrics
     led_pins = [args.led1, args.led2, args.led3]
     buz_pin  = args.buzzer
 
-    # 제어 서버
+    # 기동: 어떤 단계도 감지 루프 시작을 막지 않는다
+    #  - 제어 서버 bind, 기동 보고(서버 불통 시 최대 HTTP_TIMEOUT), PUD 자동판별(1s)은 백그라운드
+    #  - PIR 워밍업 동안은 초음파 단독 모드로 바로 보호 시작
     local_ip = get_local_ip()
     ctl_url = f"http://{local_ip}:{args.ctl_port}"
     threading.Thread(target=run_ctl_server, args=("0.0.0.0", args.ctl_port), daemon=True).start()
@@ -260,39 +576,23 @@ def main():
     log(f"[START] {dt.datetime.now():%F %T} server={args.server} device={args.device}")
     log(f"pins(BCM) PIR:{args.pir} TRIG:{args.trig} ECHO:{args.echo} LEDS:{led_pins} BUZZER:{buz_pin} PUD={used_pud}")
     log(f"control_url={ctl_url}")
-    report(args.server, args.device, "센서 클라이언트 기동 (fast+anti-flicker+buzzer-PWM)", control_url=ctl_url)
+    threading.Thread(target=report, args=(args.server, args.device, "센서 클라이언트 기동 (fast+anti-flicker+buzzer-PWM)"),
+                     kwargs={"control_url": ctl_url}, daemon=True).start()
 
     # PWM 준비 (시작은 OFF)
     global buz_pwm
     if USE_BUZZER_PWM:
         buz_pwm = GPIO.PWM(buz_pin, BUZZER_PWM_FREQ)
 
-    # PUD auto
-    if args.pud == "auto":
-        used_pud = maybe_switch_pud_auto(args.pir, used_pud)
-        if used_pud == "PUD_UP": log("PIR 입력 모드 자동 전환: PUD_UP")
-
-    # PIR 워밍업
-    if args.warmup > 0:
-        log(f"PIR 워밍업 중... {args.warmup}s 대기")
-        end = time.monotonic() + args.warmup; next_tick = 0
-        while time.monotonic() < end:
-            if time.monotonic() >= next_tick:
-                remain = int(end - time.monotonic())
-                log(f"  ...{remain}s 남음 (PIR={GPIO.input(args.pir)})")
-                next_tick = time.monotonic() + 1
-            time.sleep(0.05)
-        log("✅ PIR 센서 준비 완료")
-
     # 상태 공유
     global SYSTEM_ACTIVE, SHUTDOWN_REQUESTED
     SYSTEM_ACTIVE      = True
     SHUTDOWN_REQUESTED = False
+    pir_ready = threading.Event()  # PUD 판별 + 워밍업 완료 전에는 PIR 무시(초음파 단독 모드)
     state = {
         "in_cooldown": False,
         "cooldown_until": 0,
         "last_measure": 0,
-        "last_power_poll": 0,
         "last_report": 0,
         "last_idle_log": 0,
         "armed": True,
@@ -302,9 +602,40 @@ def main():
         "last_led_change": 0,
     }
 
-    lock = threading.Lock()
+    lock = TimedLock("lock")  # 점유/대기 시간 계측
     fast_track_enable = threading.Event()
     stop_event        = threading.Event()
+    first_protection  = threading.Event()
+
+    def mark_protected(src):
+        # 첫 유효 거리 측정 시점 = 보호 시작
+        if not first_protection.is_set():
+            first_protection.set()
+            ttfp = round(time.monotonic() - T_PROCESS_START, 3)
+            METRICS.set("time_to_first_protection_s", ttfp)
+            log(f"[START] 보호 시작 ({src}, {'PIR+초음파' if pir_ready.is_set() else '초음파 단독'}) {ttfp}s")
+
+    # ---- PIR 준비(백그라운드): PUD 자동판별 → 남은 워밍업 ----
+    def pir_prepare():
+        if args.pud == "auto":
+            pud = maybe_switch_pud_auto(args.pir, used_pud)
+            if pud == "PUD_UP": log("PIR 입력 모드 자동 전환: PUD_UP")
+        if args.warmup > 0:
+            log(f"PIR 워밍업 중... {args.warmup}s (그동안 초음파 단독 감지)")
+            if stop_event.wait(max(0.0, T_PROCESS_START + args.warmup - time.monotonic())):
+                return
+        pir_ready.set()
+        METRICS.set("pir_ready_s", round(time.monotonic() - T_PROCESS_START, 3))
+        log("✅ PIR 센서 준비 완료 → PIR+초음파 모드")
+
+    # ---- 서버 power flag 폴링(백그라운드): 서버 불통이어도 감지 루프는 멈추지 않음 ----
+    def power_poller():
+        global SYSTEM_ACTIVE
+        while not stop_event.is_set():
+            new_flag = get_power_flag(args.server, args.device, default=SYSTEM_ACTIVE)
+            if new_flag != SYSTEM_ACTIVE:
+                SYSTEM_ACTIVE = new_flag; log(f"POWER FLAG -> {SYSTEM_ACTIVE}")
+            stop_event.wait(POWER_POLL_MS / 1000.0)
 
     # ---- LED/Buzzer 제어(래치) ----
     def led_request(on: bool):
@@ -330,24 +661,35 @@ def main():
             with lock:
                 state["led_actual"] = desired
                 state["last_led_change"] = now
+            EVENTS.publish("led", on=desired, buzzer=desired)
 
     # ---------- 빠른 추적 스레드 ----------
     def fast_tracker():
         consec_close = 0
+        last_iter = None
         while not stop_event.is_set():
             if not fast_track_enable.is_set():
+                last_iter = None
                 consec_close = 0
                 time.sleep(0.05)
                 continue
 
+            t_iter = time.perf_counter()
+            if last_iter is not None:
+                METRICS.observe("fast_iter_ms", (t_iter - last_iter) * 1000)
+            last_iter = t_iter
+
             cur_pir = GPIO.input(args.pir)
+            pir_ok  = pir_ready.is_set()
             with lock:
                 active   = SYSTEM_ACTIVE
                 cool     = state["in_cooldown"]
                 armed    = state["armed"]
 
-            if active and (not cool) and cur_pir == 1 and (REARM_MODE == "cooldown" or armed):
+            if active and (not cool) and (cur_pir == 1 or not pir_ok) and (REARM_MODE == "cooldown" or armed):
                 d, err = measure_once_cm(args.trig, args.echo)
+                TRACE.record("fast", d, err, cur_pir)
+                EVENTS.publish("distance", src="fast", distance=d, error=err, pir=cur_pir)
                 if d is None:
                     consec_close = 0
                     with lock:
@@ -355,12 +697,13 @@ def main():
                             report(args.server, args.device, "초음파 응답 없음"); state["last_report"] = now_ms()
                 else:
                     log(f"[FAST] distance={d} cm")
+                    mark_protected("fast")
                     if d <= DISTANCE_THRESHOLD_CM:
                         consec_close += 1
                     else:
                         consec_close = 0
 
-                    if consec_close >= CONSEC_CLOSE_REQUIRED:
+                    if consec_close >= (CONSEC_CLOSE_REQUIRED if pir_ok else WARMUP_CONSEC_CLOSE):
                         led_request(True)
                         with lock:
                             state["in_cooldown"]    = True
@@ -371,25 +714,35 @@ def main():
                                 report(args.server, args.device, "사람 감지 및 LED/BUZZER 점등(FAST)", distance=d)
                                 state["last_report"] = now_ms()
                         consec_close = 0
-            time.sleep(FAST_TRACK_INTERVAL_MS / 1000.0)
+            sleep_tracked(FAST_TRACK_INTERVAL_MS / 1000.0, "fast_jitter_ms")
 
     th = threading.Thread(target=fast_tracker, daemon=True); th.start()
 
+    th_pir = threading.Thread(target=pir_prepare, daemon=True); th_pir.start()
+    threading.Thread(target=power_poller, daemon=True).start()
+
+    TRACE.enabled = TRACE_ENABLED and not args.no_trace
+    if TRACE.enabled:
+        threading.Thread(target=TRACE.run_uploader, args=(args.server, args.device, stop_event), daemon=True).start()
+
     prev_pir = GPIO.input(args.pir)
 
     try:
+        last_iter = None
+        warmup_close = 0  # 초음파 단독 모드에서 주기 측정의 연속 근접 횟수
         while not SHUTDOWN_REQUESTED:
             now = now_ms()
-
-            # 서버 power flag
-            if now - state["last_power_poll"] >= POWER_POLL_MS:
-                state["last_power_poll"] = now
-                new_flag = get_power_flag(args.server, args.device, default=SYSTEM_ACTIVE)
-                if new_flag != SYSTEM_ACTIVE:
-                    SYSTEM_ACTIVE = new_flag; log(f"POWER FLAG -> {SYSTEM_ACTIVE}")
+            t_iter = time.perf_counter()
+            if last_iter is not None:
+                METRICS.observe("main_iter_ms", (t_iter - last_iter) * 1000)
+            last_iter = t_iter
 
             cur_pir = GPIO.input(args.pir)
-            if cur_pir != prev_pir:
+            pir_ok  = pir_ready.is_set()
+            presence = cur_pir == 1 or not pir_ok  # 워밍업 중에는 항상 측정
+            if not pir_ok:
+                prev_pir = cur_pir  # 워밍업 중 PIR 변화는 무시
+            elif cur_pir != prev_pir:
                 log("PIR:", "사람 감지됨" if cur_pir else "움직임 없음")
                 prev_pir = cur_pir
                 if cur_pir == 0 and now - state["last_report"] >= REPORT_MIN_INTERVAL_MS:
@@ -403,13 +756,13 @@ def main():
                 leds_state = "".join("1" if GPIO.input(p) else "0" for p in led_pins)
                 buz_state  = "1" if GPIO.input(buz_pin) else "0"
                 with lock:
-                    hb = f"[HB] active={SYSTEM_ACTIVE} PIR={'HIGH' if cur_pir else 'LOW '} LEDS={leds_state} BUZ={buz_state} cooldown={state['in_cooldown']} armed={state['armed']}"
+                    hb = f"[HB] active={SYSTEM_ACTIVE} PIR={'HIGH' if cur_pir else 'LOW '}{'' if pir_ok else '(warmup)'} LEDS={leds_state} BUZ={buz_state} cooldown={state['in_cooldown']} armed={state['armed']}"
                 log(hb)
 
             if not SYSTEM_ACTIVE:
                 fast_track_enable.clear()
                 led_manager()
-                time.sleep(0.2)
+                sleep_tracked(0.2, "main_jitter_ms")
                 continue
 
             # 쿨다운 관리
@@ -423,12 +776,12 @@ def main():
                 # OFF는 여기서만 수행(안티-플리커 정책 유지)
                 led_request(False)
                 log("쿨다운 종료 → LEDs/Buzzer OFF")
-                if REARM_MODE == "cooldown":
-                    if GPIO.input(args.pir) == 1:
+                if REARM_MODE == "cooldown" or not pir_ok:
+                    if GPIO.input(args.pir) == 1 or not pir_ok:
                         with lock: state["armed"] = True
 
             # 빠른 추적 활성 조건
-            if SYSTEM_ACTIVE and (not in_cd) and cur_pir == 1:
+            if SYSTEM_ACTIVE and (not in_cd) and presence:
                 fast_track_enable.set()
             else:
                 fast_track_enable.clear()
@@ -436,14 +789,23 @@ def main():
             # 보강용 주기 측정
             if (now - state["last_measure"]) >= MEASUREMENT_INTERVAL_MS and not in_cd:
                 state["last_measure"] = now
-                if cur_pir == 1:
-                    d, err = measure_median_cm(args.trig, args.echo, n=ULTRA_SAMPLES)
+                if presence:
+                    d, err = measure_median_cm(args.trig, args.echo, n=ULTRA_SAMPLES, pir=cur_pir)
+                    EVENTS.publish("distance", src="periodic", distance=d, error=err, pir=cur_pir)
                     if d is None:
+                        warmup_close = 0
                         if now - state["last_report"] >= REPORT_MIN_INTERVAL_MS:
                             report(args.server, args.device, "초음파 응답 없음"); state["last_report"] = now
                     else:
                         log(f"Measured distance (median {ULTRA_SAMPLES}): {d} cm")
-                        if d <= DISTANCE_THRESHOLD_CM:
+                        mark_protected("periodic")
+                        close = d <= DISTANCE_THRESHOLD_CM
+                        # PIR 미사용(워밍업) 중에는 fast 경로와 같이 WARMUP_CONSEC_CLOSE회 연속 근접이어야 점등
+                        warmup_close = warmup_close + 1 if (close and not pir_ok) else 0
+                        if close and not pir_ok and warmup_close < WARMUP_CONSEC_CLOSE:
+                            log(f"  (워밍업: 연속 근접 {warmup_close}/{WARMUP_CONSEC_CLOSE})")
+                        elif close:
+                            warmup_close = 0
                             led_request(True)
                             with lock:
                                 state["in_cooldown"]    = True
@@ -463,11 +825,16 @@ def main():
 
             # 실제 적용
             led_manager()
-            time.sleep(0.003)
+            sleep_tracked(0.003, "main_jitter_ms")
 
     except KeyboardInterrupt:
         pass
     finally:
+        # 백그라운드 스레드(빠른 추적·PIR 준비·전원 폴링)를 먼저 멈춘 뒤 GPIO 정리
+        stop_event.set()
+        fast_track_enable.clear()
+        th.join(timeout=HTTP_TIMEOUT + 0.5)  # 진행 중인 측정/보고가 끝날 때까지
+        th_pir.join(timeout=1.5)             # PUD 자동판별(1s) 진행 중일 수 있음
         try:
             if buz_pwm is not None:
                 buz_pwm.stop()
@@ -476,6 +843,7 @@ def main():
         GPIO.output(buz_pin, GPIO.LOW)
         for p in led_pins: GPIO.output(p, GPIO.LOW)
         GPIO.cleanup()
+        if TRACE.enabled: TRACE.drain(args.server, args.device)
         report(args.server, args.device, "센서 클라이언트 종료")
         log(f"[STOP] {dt.datetime.now():%F %T}")
 